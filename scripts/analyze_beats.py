@@ -1,26 +1,68 @@
+import os
 import sys
 import json
+import tempfile
+
+# librosa's Numba kernels are compiled with cache=True, but the cache silently
+# turns off when site-packages is read-only (as in our containers). Point it at a
+# writable directory so JIT compilation is paid once, not on every invocation.
+# Must be set before librosa (and therefore numba) is imported.
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'numba_cache'))
+
 import numpy as np
 import librosa
+import soundfile
+
+try:
+    # Optional: serializes numpy arrays natively, skipping the .tolist() copy.
+    import orjson
+except ImportError:
+    orjson = None
+
+# Beat tracking works on a ~43 Hz onset envelope, so anything above librosa's
+# default rate only adds STFT work. Resample down to this before analysis.
+TARGET_SR = 22050
+# Fastest resampler bundled with librosa (kaiser_fast needs the optional resampy).
+RES_TYPE = 'soxr_qq'
+# Onset-envelope hop; beat_track and frames_to_time must agree on it.
+HOP_LENGTH = 512
+
+def load_audio(file_path):
+    # Decode through libsndfile directly; librosa.load goes via audioread for
+    # many formats, which is much slower. Fall back to librosa for anything
+    # libsndfile can't read.
+    try:
+        y, sr = soundfile.read(file_path, dtype='float32', always_2d=False)
+    except Exception:
+        return librosa.load(file_path, sr=TARGET_SR, res_type=RES_TYPE)
+
+    # Downmix multi-channel audio to mono
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    if sr > TARGET_SR:
+        y = librosa.resample(y, orig_sr=sr, target_sr=TARGET_SR, res_type=RES_TYPE)
+        sr = TARGET_SR
+    return y, sr
 
 def analyze_beats(file_path):
     try:
         # Load the audio file
-        # sr=None preserves the native sampling rate
-        y, sr = librosa.load(file_path, sr=None)
+        y, sr = load_audio(file_path)
+        # Keep the onset STFT in float32: a float64 buffer would double its memory traffic
+        y = np.ascontiguousarray(y, dtype=np.float32)
 
         # Detect beat frames
-        tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+        tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, hop_length=HOP_LENGTH)
 
         # Convert beat frames to timestamps
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-
-        # Convert to list of floats for JSON serialization
-        # beat_times is a numpy array, so we need to convert it
-        beat_times_list = beat_times.tolist()
+        beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=HOP_LENGTH)
 
         # Output JSON array to stdout
-        print(json.dumps(beat_times_list))
+        if orjson is not None:
+            sys.stdout.buffer.write(orjson.dumps(beat_times, option=orjson.OPT_SERIALIZE_NUMPY) + b'\n')
+        else:
+            # beat_times is a numpy array, so it needs converting for the json module
+            print(json.dumps(beat_times.tolist()))
 
     except Exception as e:
         # Handle errors gracefully and output JSON error object
@@ -4,246 +4,1013 @@ import argparse
 import sys
 import os
 import re
-import ffmpeg
+import shutil
+import subprocess
+import functools
+import math
+import concurrent.futures
+import contextlib
+import dataclasses
+import multiprocessing
+import ast
+import operator
+import struct
+import numpy as np
 
-def process_segment(segment, index, output_path, width, height, font_settings, include_subtitles=True):
+# Default threads handed to each ffmpeg child. Segments are encoded concurrently,
+# so workers * threads per job should roughly match the core count.
+THREADS_PER_JOB = 2
+
+# H.264 encoders by --hwaccel name, in the order `auto` tries them.
+HW_ENCODERS = {
+    'nvenc': 'h264_nvenc',
+    'qsv': 'h264_qsv',
+    'vt': 'h264_videotoolbox',
+}
+
+# Per-encoder input (decode) and output (rate control) options.
+# Hardware decode keeps frames in system memory so the CPU filters still apply.
+ENCODER_SETTINGS = {
+    'libx264': {
+        'input': {},
+        # The delivered file: CRF holds quality, veryfast keeps B-frames and
+        # lookahead. A 2s GOP at 30fps keeps keyframes regular without the
+        # default 250-frame interval.
+        'output': {'preset': 'veryfast', 'crf': 18, 'g': 60},
+        # --per_segment files are joined by stream copy, each encoded by a worker
+        # with only a couple of threads: trade file size for encode speed. CRF keeps
+        # the quality the same. zerolatency also drops B-frames and lookahead, the
+        # costliest analysis passes; fine for temp segments, not the single-pass
+        # output where file size counts.
+        'segment_output': {'preset': 'ultrafast', 'tune': 'zerolatency'},
+    },
+    'h264_nvenc': {
+        'input': {'hwaccel': 'cuda'},
+        'output': {'preset': 'p4', 'rc': 'vbr', 'cq': 23},
+    },
+    'h264_qsv': {
+        'input': {'hwaccel': 'qsv'},
+        'output': {'preset': 'veryfast', 'global_quality': 23},
+    },
+    'h264_videotoolbox': {
+        'input': {'hwaccel': 'videotoolbox'},
+        'output': {'b:v': '4000k'},
+    },
+}
+
+# Sample rate shared by every segment's audio track.
+AUDIO_SAMPLE_RATE = 48000
+
+# Narration within 1% of the target length plays as-is (the apad/atrim below
+# absorbs the difference); beyond MAX_TEMPO either way the duration is bogus.
+TEMPO_TOLERANCE = 0.01
+MAX_TEMPO = 10.0
+
+# Above this many segments main() falls back to --per_segment: the single-pass graph
+# keeps every segment's demuxers and decoders open for the whole run.
+SINGLE_PASS_MAX_SEGMENTS = 64
+
+# Decoded-frame budget for the ping-pong loop, which holds the whole clip in RAM
+# (see pingpong_bytes); longer clips loop forward instead.
+PINGPONG_MAX_BYTES = 256 * 1024 * 1024
+
+# Consumer NVIDIA cards only allow a handful of concurrent NVENC sessions.
+NVENC_MAX_SESSIONS = 2
+
+# Per-worker semaphore bounding concurrent NVENC encodes (set by _init_worker).
+_hw_sessions = None
+
+# FfmpegCaps for this process (see ffmpeg_caps); workers receive main's copy.
+_CAPS = None
+
+# Subtitle script for the libass `ass` filter: white text on an opaque black box
+# (BorderStyle 3, box colour = OutlineColour), top-centre anchored at MarginV.
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 2
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,{font},{fontsize},&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,3,{box},0,8,0,0,{margin_v},1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+# libass sizes a font so its ascent+descent (OS/2 winAscent+winDescent) spans
+# Fontsize, drawtext so its em does; Fontsize is scaled by that ratio (see
+# ass_font_scale). Arial/Liberation Sans: (1854 + 434) / 2048, used for fonts
+# requested by name, which can't be measured here.
+ASS_DEFAULT_FONT_SCALE = 2288 / 2048
+
+# Text cleanup: [tags] are dropped, dashes become word breaks, whitespace collapses.
+_BRACKET_RE = re.compile(r'\[.*?\]')
+_WS_RE = re.compile(r'\s+')
+_DASH_TO_SPACE = str.maketrans('-', ' ')
+
+# Backslash escapes, one translate() pass each: filter option values, then the
+# filter graph around them, and ASS override-tag characters in subtitle text.
+_OPTION_ESCAPE = str.maketrans({ch: '\\' + ch for ch in "\\'=:"})
+_GRAPH_ESCAPE = str.maketrans({ch: '\\' + ch for ch in "\\'[],;"})
+_ASS_ESCAPE = str.maketrans({ch: '\\' + ch for ch in '\\{}'})
+
+# Arithmetic allowed in --y_pos when it is turned into a pixel offset.
+_EXPR_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub,
+    ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+
+def filter_arg(value):
+    """Quote one filter option value for -filter_complex.
+
+    Escaped once for the option parser (':' separates options) and once more for
+    the graph parser (',', ';' and '[]' delimit filters and pads).
+    """
+    return str(value).translate(_OPTION_ESCAPE).translate(_GRAPH_ESCAPE)
+
+def filter_spec(name, *args, **kwargs):
+    """One filter of a chain: name=arg:...:key=value."""
+    params = [filter_arg(a) for a in args] + [f"{k}={filter_arg(v)}" for k, v in kwargs.items()]
+    return f"{name}={':'.join(params)}" if params else name
+
+def option_args(options):
+    """{'crf': 18, 'tune': 'zerolatency'} -> ['-crf', '18', '-tune', 'zerolatency']."""
+    return [arg for key, value in options.items() for arg in (f'-{key}', str(value))]
+
+def add_input(inputs, path, **options):
+    """Append one `[options] -i path` to `inputs` and return its input index."""
+    inputs.append([*option_args(options), '-i', path])
+    return len(inputs) - 1
+
+def ffmpeg_command(inputs, graph, maps, output_args, output_path, global_args=()):
+    """Assemble the ffmpeg argv for `inputs` -> `graph` -> `output_path`."""
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *global_args]
+    for input_args in inputs:
+        cmd += input_args
+    if graph:
+        cmd += ['-filter_complex', ';'.join(graph)]
+    for stream in maps:
+        cmd += ['-map', stream]
+    return cmd + output_args + [output_path]
+
+def run_ffmpeg(cmd, stdin_data=None):
+    """Run an ffmpeg argv; on failure echo its stderr and raise RuntimeError.
+
+    `stdin_data` (bytes) is fed to ffmpeg's stdin, e.g. for a `pipe:0` input.
+    """
+    result = subprocess.run(cmd, input=stdin_data, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr.decode(errors='replace'))
+        raise RuntimeError(f"ffmpeg exited with status {result.returncode}")
+
+def _ffmpeg_output(*args):
+    """stdout of `ffmpeg -hide_banner <args>`, or '' if it can't be run."""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', *args], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Warning: Could not run ffmpeg {' '.join(args)}: {e}", file=sys.stderr)
+        return ''
+    return result.stdout
+
+def _listed_names(listing):
+    """Second column of an ffmpeg -filters/-encoders listing."""
+    # Lines look like " ... ass               V->V       Render ASS subtitles ..."
+    # or " V....D libx264   libx264 H.264 ...".
+    return frozenset(parts[1] for parts in map(str.split, listing.splitlines()) if len(parts) >= 2)
+
+def encoder_works(name):
+    """True if `name` can encode one frame here.
+
+    Builds list hardware encoders whether or not the host has the device (e.g. an
+    ffmpeg with h264_nvenc on a box without a GPU), so -encoders alone isn't enough.
+    """
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+        '-frames:v', '1', '-c:v', name, '-f', 'null', '-',
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=15).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+@dataclasses.dataclass(frozen=True)
+class FfmpegCaps:
+    """What the local ffmpeg build offers; gathered once per run (see ffmpeg_caps)."""
+    version: str
+    filters: frozenset
+    encoders: frozenset
+
+    def has_filter(self, name):
+        return name in self.filters
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def best_h264_encoder(self, hwaccel='auto'):
+        """Map the --hwaccel flag to an ffmpeg video encoder, falling back to libx264."""
+        if hwaccel == 'none':
+            return 'libx264'
+        candidates = list(HW_ENCODERS.values()) if hwaccel == 'auto' else [HW_ENCODERS[hwaccel]]
+        for name in candidates:
+            if self.has_encoder(name) and encoder_works(name):
+                return name
+        # auto quietly settles for libx264 (main logs the encoder it runs with).
+        if hwaccel != 'auto':
+            print(f"Warning: No hardware encoder available for --hwaccel {hwaccel}, using libx264", file=sys.stderr)
+        return 'libx264'
+
+def _probe_capabilities():
+    version_lines = _ffmpeg_output('-version').splitlines()
+    return FfmpegCaps(
+        version=version_lines[0] if version_lines else 'unknown',
+        filters=_listed_names(_ffmpeg_output('-filters')),
+        encoders=_listed_names(_ffmpeg_output('-encoders')),
+    )
+
+def ffmpeg_caps():
+    """The cached FfmpegCaps, probed on first use (pool workers get main's copy)."""
+    global _CAPS
+    if _CAPS is None:
+        _CAPS = _probe_capabilities()
+    return _CAPS
+
+@functools.lru_cache(maxsize=None)
+def _probe_cached(path, size, mtime):
+    result = subprocess.run(
+        # -show_data_hash adds extradata_hash (the SPS/PPS) for copy_params.
+        ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-show_data_hash', 'md5', '-of', 'json', path],
+        capture_output=True, check=True,
+    )
+    return json.loads(result.stdout)
+
+def _probe(path, probe_cache=None):
+    """ffprobe a file once; segments that reuse a clip share the result.
+
+    Looked up in `probe_cache` (from probe_all) first; otherwise keyed on
+    (path, size, mtime) so a file rewritten in place is probed again.
+    """
+    path = os.path.abspath(path)
+    if probe_cache and path in probe_cache:
+        return probe_cache[path]
+    st = os.stat(path)
+    return _probe_cached(path, st.st_size, st.st_mtime)
+
+def probe_all(paths):
+    """ffprobe every unique path concurrently; returns {abspath: probe}.
+
+    ffprobe runs are I/O bound, so a thread pool overlaps their process startups.
+    Files that fail to probe are left out (callers warn and fall back to 0).
+    """
+    unique = sorted({os.path.abspath(p) for p in paths if p})
+    def probe_one(path):
+        try:
+            return path, _probe(path)
+        except Exception:
+            return path, None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(16, max(1, len(unique)))) as executor:
+        return {path: probe for path, probe in executor.map(probe_one, unique) if probe is not None}
+
+def probe_duration(path, codec_type, probe_cache=None):
+    """Duration of the first `codec_type` stream, falling back to the container."""
+    probe = _probe(path, probe_cache)
+    stream_info = next((s for s in probe['streams'] if s['codec_type'] == codec_type), None)
+    if stream_info and 'duration' in stream_info:
+        return float(stream_info['duration'])
+    if 'format' in probe and 'duration' in probe['format']:
+        return float(probe['format']['duration'])
+    return 0
+
+def missing_inputs(segments):
+    """'Segment i: label path' for every input file that doesn't exist.
+
+    The stats run on a thread pool so their latency overlaps on network storage.
+    """
+    checks = []
+    for i, seg in enumerate(segments):
+        if not seg.get('video'):
+            checks.append((i, 'missing \'video\' field', None))
+            continue
+        checks.append((i, 'video file not found', seg['video']))
+        if seg.get('audio'):
+            checks.append((i, 'audio file not found', seg['audio']))
+    paths = [path for _, _, path in checks if path]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, max(1, len(paths)))) as executor:
+        found = dict(zip(paths, executor.map(os.path.isfile, paths)))
+    return [f"Segment {i}: {label}" + (f": {path}" if path else '') for i, label, path in checks if not path or not found[path]]
+
+def probe_segment_durations(segment, probe_cache=None):
+    """(video_duration, audio_duration) for a segment, 0 where unknown.
+
+    Manifest writers that already know the narration length can set the optional
+    `audio_duration_s` key (seconds) so the audio needs no ffprobe. There is no
+    video counterpart: videos are probed anyway for their stream info (see main).
+    """
+    durations = []
+    for codec_type in ('video', 'audio'):
+        path = segment.get(codec_type)
+        duration = 0
+        known = segment.get('audio_duration_s') if codec_type == 'audio' else None
+        alignment = segment.get('alignment') or {}
+        if path and known is not None:
+            duration = float(known)
+        elif codec_type == 'audio' and path and alignment.get('character_end_times_seconds'):
+            # The TTS alignment already ends where the speech does; no ffprobe needed.
+            duration = float(alignment['character_end_times_seconds'][-1])
+        elif path:
+            try:
+                duration = probe_duration(path, codec_type, probe_cache)
+            except Exception as e:
+                print(f"Warning: Could not probe {codec_type} {path}: {e}", file=sys.stderr)
+        durations.append(duration)
+    return tuple(durations)
+
+def video_rotated(stream):
+    """True if a probed video stream carries a display rotation.
+
+    ffmpeg autorotates such clips, so the frames reaching the filters don't have
+    the coded width/height ffprobe reports.
+    """
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    try:
+        return float(rotation) % 360 != 0
+    except (TypeError, ValueError):
+        return True
+
+def video_conforms(path, width, height, probe_cache=None):
+    """True if the clip's video is already width x height, 30fps, square-pixel yuv420p H.264."""
+    probe = _probe(path, probe_cache)
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if not stream:
+        return False
+    return (
+        stream.get('codec_name') == 'h264'
+        and stream.get('width') == width
+        and stream.get('height') == height
+        and stream.get('r_frame_rate') in ('30/1', '30')
+        and stream.get('sample_aspect_ratio', '1:1') in ('1:1', '0:1')
+        and stream.get('pix_fmt') == 'yuv420p'
+        # B-frames would leave frames referencing packets past the -t cut.
+        and stream.get('has_b_frames') == 0
+        and not video_rotated(stream)
+    )
+
+def copy_params(path, probe_cache=None):
+    """Codec parameters stream-copied clips must share to be joined by the concat demuxer.
+
+    The joined file keeps the first clip's SPS/PPS and time base, so every copied
+    clip needs the same ones; None when the probe lacks any of them.
+    """
+    probe = _probe(path, probe_cache)
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if not stream:
+        return None
+    params = tuple(stream.get(key) for key in ('profile', 'level', 'time_base', 'extradata_hash'))
+    return None if None in params else params
+
+def conform_steps(path, width, height, probe_cache=None):
+    """Which of (scale+pad, fps, format) the clip needs to reach the target; all if unprobeable."""
+    try:
+        probe = _probe(path, probe_cache)
+    except Exception:
+        return True, True, True
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if not stream:
+        return True, True, True
+    return (
+        (stream.get('width'), stream.get('height')) != (width, height) or video_rotated(stream),
+        stream.get('r_frame_rate') not in ('30/1', '30'),
+        stream.get('pix_fmt') != 'yuv420p',
+    )
+
+def pingpong_bytes(video_path, video_duration, probe_cache=None):
+    """Rough RAM the ping-pong loop needs for a clip, or None if it can't be probed.
+
+    `reverse` buffers every decoded frame, and `loop` then keeps the forward and
+    reversed copies, so about three yuv420p copies of the clip are resident.
+    """
+    try:
+        probe = _probe(video_path, probe_cache)
+    except Exception:
+        return None
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if not stream or not stream.get('width') or not stream.get('height'):
+        return None
+    num, _, den = stream.get('r_frame_rate', '30/1').partition('/')
+    try:
+        fps = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        fps = 30.0
+    frame_bytes = stream['width'] * stream['height'] * 3 // 2
+    return int(3 * video_duration * fps * frame_bytes)
+
+def eval_position_expr(expr, **names):
+    """Evaluate a drawtext-style position such as '(h-text_h)/1.2' to pixels.
+
+    Plain arithmetic over the given names only; anything else (functions such as
+    if() or max()) raises ValueError.
+    """
+    def _eval(node):
+        if isinstance(node, ast.Expression):
+            return _eval(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in names:
+            return names[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in _EXPR_OPS:
+            return _EXPR_OPS[type(node.op)](_eval(node.left), _eval(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _EXPR_OPS:
+            return _EXPR_OPS[type(node.op)](_eval(node.operand))
+        raise ValueError(f"Unsupported position expression: {expr}")
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Unsupported position expression: {expr}") from e
+    return _eval(tree)
+
+@functools.lru_cache(maxsize=None)
+def font_family(font_path):
+    """Family name libass must request to pick up `font_path` from fontsdir."""
+    try:
+        result = subprocess.run(['fc-scan', '--format', '%{family[0]}', font_path], capture_output=True, text=True, check=True)
+        if result.stdout.strip():
+            return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return os.path.splitext(os.path.basename(font_path))[0]
+
+@functools.lru_cache(maxsize=None)
+def ass_font_scale(font_path):
+    """ASS Fontsize per drawtext fontsize for a TrueType/OpenType file, read from its tables."""
+    try:
+        with open(font_path, 'rb') as f:
+            data = f.read()
+        base = 0
+        if data[:4] == b'ttcf':
+            # Collection: libass picks the first face.
+            base = struct.unpack_from('>I', data, 12)[0]
+        num_tables = struct.unpack_from('>H', data, base + 4)[0]
+        tables = {}
+        for i in range(num_tables):
+            tag, _, offset, _ = struct.unpack_from('>4sIII', data, base + 12 + 16 * i)
+            tables[tag] = offset
+        units_per_em = struct.unpack_from('>H', data, tables[b'head'] + 18)[0]
+        height = 0
+        if b'OS/2' in tables:
+            win_ascent, win_descent = struct.unpack_from('>HH', data, tables[b'OS/2'] + 74)
+            height = win_ascent + win_descent
+        if not height and b'hhea' in tables:
+            ascender, descender = struct.unpack_from('>hh', data, tables[b'hhea'] + 4)
+            height = ascender - descender
+        if units_per_em and height > 0:
+            return height / units_per_em
+    except (OSError, KeyError, struct.error):
+        pass
+    return ASS_DEFAULT_FONT_SCALE
+
+def alignment_arrays(alignment):
+    """(chars, starts, ends) NumPy arrays from a TTS alignment dict, converted once.
+
+    Times become float32 (4 bytes each, vs a boxed Python float per entry); all
+    three are cut to a common length in case the lists disagree.
+    """
+    chars = alignment.get('characters') or []
+    starts = alignment.get('character_start_times_seconds') or []
+    ends = alignment.get('character_end_times_seconds') or []
+    n = min(len(chars), len(starts), len(ends))
+    return (
+        np.asarray(chars[:n], dtype=str),
+        np.asarray(starts[:n], dtype=np.float32),
+        np.asarray(ends[:n], dtype=np.float32),
+    )
+
+def _clamped_depth(step):
+    """Running sum of `step` that never goes below 0 (a stray ']' doesn't go negative)."""
+    total = np.cumsum(step)
+    return total - np.minimum(np.minimum.accumulate(total), 0)
+
+def words_from_alignment(chars, starts, ends, scale=1.0):
+    """Group per-character alignment arrays (see alignment_arrays) into (word, start, end) tuples.
+
+    Whitespace separates words; [bracketed] tags are dropped, matching clean_text.
+    Stray brackets are skipped: a ']' with no open tag, and a '[' that is never
+    closed (the text after it is kept, as clean_text keeps it).
+    """
+    if len(chars) == 0:
+        return []
+    opens = chars == '['
+    closes = chars == ']'
+    step = opens.astype(np.int32) - closes.astype(np.int32)
+    depth = _clamped_depth(step)
+    # A '[' is closed only if the depth later drops below the level it opened.
+    later_min = np.append(np.minimum.accumulate(depth[::-1])[::-1][1:], np.iinfo(depth.dtype).max)
+    unclosed = opens & (later_min >= depth)
+    if unclosed.any():
+        depth = _clamped_depth(step - unclosed)
+    is_space = np.char.isspace(chars)
+    kept = np.flatnonzero((depth == 0) & ~opens & ~closes & ~is_space)
+    if kept.size == 0:
+        return []
+    # Kept characters sharing a whitespace-delimited token form one word.
+    token = np.cumsum(is_space)[kept]
+    bounds = np.flatnonzero(np.diff(token)) + 1
+    first = np.concatenate(([0], bounds))
+    last = np.concatenate((bounds, [kept.size])) - 1
+    w_starts = starts[kept[first]] * scale
+    w_ends = ends[kept[last]] * scale
+    text = ''.join(chars[kept])
+    return [(text[a:b + 1], float(s), float(e)) for a, b, s, e in zip(first, last, w_starts, w_ends)]
+
+def resolve_font(font):
+    """(font, is_file) for --font: an absolute font file path, else Arial."""
+    if font and os.path.isfile(font):
+        return os.path.abspath(font), True
+    return 'Arial', False
+
+def ass_time(seconds):
+    """ASS timestamp, H:MM:SS.cc."""
+    cs = max(0, int(round(seconds * 100)))
+    return f"{cs // 360000}:{cs // 6000 % 60:02d}:{cs // 100 % 60:02d}.{cs % 100:02d}"
+
+def ass_escape(word):
+    """Keep braces/backslashes from being read as ASS override tags."""
+    return word.translate(_ASS_ESCAPE)
+
+def write_ass(ass_path, words_with_timing, width, height, font, fontsize, box, margin_v):
+    """Write one Dialogue line per timed word."""
+    with open(ass_path, 'w', encoding='utf-8') as f:
+        f.write(ASS_HEADER.format(width=width, height=height, font=font, fontsize=fontsize, box=box, margin_v=margin_v))
+        for word, w_start, w_end in words_with_timing:
+            f.write(f"Dialogue: 0,{ass_time(w_start)},{ass_time(w_end)},Default,,0,0,0,,{ass_escape(word)}\n")
+
+def stretch_tempo(input_audio_duration, target_duration):
+    """Tempo that fits the narration into the target, or None when no stretch is needed.
+
+    Raises ValueError for ratios beyond MAX_TEMPO, which only come from bad
+    durations and would make an unusable filter.
+    """
+    if input_audio_duration <= 0 or target_duration <= 0:
+        return None
+    tempo = input_audio_duration / target_duration
+    if not 1 / MAX_TEMPO < tempo < MAX_TEMPO:
+        raise ValueError(f"Audio tempo {tempo:.3f} out of range (input {input_audio_duration}s, target {target_duration}s)")
+    if abs(tempo - 1.0) < TEMPO_TOLERANCE:
+        return None
+    return tempo
+
+def atempo_chain(tempo):
+    """atempo filters whose product is `tempo`.
+
+    Each stage must stay within 0.5..2.0, so large factors are split into
+    ceil(|log2 tempo|) equal stages (4.5 -> 3 x 1.651 rather than
+    2.0 * 2.0 * 1.125), keeping every pass as close to 1.0 as possible.
+    """
+    stages = max(1, math.ceil(abs(math.log2(tempo))))
+    per_stage = tempo ** (1.0 / stages)
+    return [filter_spec('atempo', f'{per_stage:.6f}')] * stages
+
+@functools.lru_cache(maxsize=None)
+def conform_chain(width, height, scale=True, fps=True, fmt=True):
+    """scale/format/pad/setsar/fps chain shared by every segment, built once per size.
+
+    One linear chain. `format` sits directly after `scale` so swscale resizes and
+    converts pixels in a single pass, and pad/fps then move yuv420p frames only.
+    Steps the clip already satisfies can be switched off; setsar always stays.
+    """
+    chain = []
+    if scale:
+        chain.append(filter_spec('scale', width, height, force_original_aspect_ratio='decrease'))
+    if fmt:
+        chain.append(filter_spec('format', 'yuv420p'))
+    if scale:
+        chain.append(filter_spec('pad', width, height, '(ow-iw)/2', '(oh-ih)/2'))
+    chain.append(filter_spec('setsar', '1'))
+    if fps:
+        chain.append(filter_spec('fps', fps=30))
+    return ','.join(chain)
+
+def build_segment_graph(segment, index, width, height, font_settings, inputs, include_subtitles=True, encoder='libx264', durations=None, asset_dir=None, copy_video=False, probe_cache=None):
+    """Build one segment's -filter_complex chains, not yet output.
+
+    Input arguments are appended to `inputs` (shared when several segments go into
+    one command). Returns (graph, video, audio, duration, assets): `graph` is a list
+    of filter chains, `video`/`audio` the output pads ('[v0]', '[a0]'), and `assets`
+    temp files (the subtitle script written to `asset_dir`) the caller removes once
+    ffmpeg has run. With `copy_video` the video is the untouched input stream
+    ('0:v:0'), cut on the input side, for callers that stream-copy it (see
+    can_copy_video).
+    """
     video_path = segment.get('video')
     audio_path = segment.get('audio')
     text = segment.get('text', '')
     # STRICT DURATION FROM BACKEND (Target aligned to beats)
     target_duration = segment.get('duration') 
     
-    if not video_path or not os.path.exists(video_path):
-        raise FileNotFoundError(f"Video file not found: {video_path}")
-    if not audio_path or not os.path.exists(audio_path):
-        raise FileNotFoundError(f"Audio file not found: {audio_path}")
+    if not video_path:
+        raise FileNotFoundError(f"Segment {index} missing 'video' field.")
+    # One stat per input; audio is optional (segments without narration get
+    # silence generated in-graph).
+    for label, path in (('Video', video_path), ('Audio', audio_path)):
+        if not path:
+            continue
+        try:
+            os.stat(path)
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"{label} file not found: {path}") from e
     if target_duration is None:
         raise ValueError(f"Segment {index} missing 'duration' field.")
 
-    # Probe Video Duration
-    video_duration = 0
-    try:
-        probe = ffmpeg.probe(video_path)
-        # Try to get video stream duration
-        video_stream_info = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
-        if video_stream_info and 'duration' in video_stream_info:
-            video_duration = float(video_stream_info['duration'])
-        # Fallback to container duration
-        elif 'format' in probe and 'duration' in probe['format']:
-             video_duration = float(probe['format']['duration'])
-    except Exception as e:
-        print(f"Warning: Could not probe video {video_path}: {e}", file=sys.stderr)
-
-    # Probe Audio Duration for time-stretching
-    input_audio_duration = 0
-    try:
-        a_probe = ffmpeg.probe(audio_path)
-        a_stream_info = next((s for s in a_probe['streams'] if s['codec_type'] == 'audio'), None)
-        if a_stream_info and 'duration' in a_stream_info:
-            input_audio_duration = float(a_stream_info['duration'])
-        elif 'format' in a_probe and 'duration' in a_probe['format']:
-             input_audio_duration = float(a_probe['format']['duration'])
-    except Exception as e:
-        print(f"Warning: Could not probe audio {audio_path}: {e}", file=sys.stderr)
-
+    # Probe Video Duration, and Audio Duration for time-stretching
+    # (main() pre-probes all segments and passes the results in)
+    if durations is None:
+        durations = probe_segment_durations(segment)
+    video_duration, input_audio_duration = durations
 
     # STRICT MODE: Respect the duration passed from backend
     final_duration = target_duration
+    codec_settings = ENCODER_SETTINGS[encoder]
+    assets = []
+    graph = []
+    asset_dir = asset_dir or os.getcwd()
+    asset_prefix = f"sub_{os.getpid()}_{index}"
 
-    try:
-        print(f"Segment {index}: InAudio={input_audio_duration}s | Target={target_duration}s | VideoDur={video_duration}s", file=sys.stderr)
+    print(f"Segment {index}: InAudio={input_audio_duration}s | Target={target_duration}s | VideoDur={video_duration}s", file=sys.stderr)
+    
+    # Smart Stitching Logic
+    # Calculate audio/video ratio to decide strategy
+    # Video ratio: If we want video to fit target.
+    # We already handle video stretching below based on `target_duration` vs `video_duration`.
+    video_ratio = target_duration / video_duration if video_duration > 0 else 1.0
+    print(f"Segment {index}: Ratio Video: {video_ratio:.2f}", file=sys.stderr)
+
+    # 1. VIDEO PIPELINE
+    # `v_src` feeds the linear chain `vf`, which ends at this segment's [v] pad.
+    vf = []
+    if copy_video:
+        print(f"Segment {index}: Video already conforms, stream-copying", file=sys.stderr)
+        v_in = add_input(inputs, video_path, ss=0, t=final_duration)
+        v_src = None
+    elif video_duration >= target_duration:
+        # Case 1: Video is long enough. Just trim.
+        # Trim on the input side (-t) so the demuxer stops reading once enough
+        # frames are in, instead of decoding the whole clip and dropping the tail.
+        # ffmpeg already rebases input timestamps to 0, so no setpts is needed.
+        v_in = add_input(inputs, video_path, t=final_duration, **codec_settings['input'])
+        v_src = f"[{v_in}:v:0]"
+    
+    else:
+        # Video is shorter. Smart Loop.
+        # Use video_ratio. Atempo logic for video is `setpts`. 
+        # setpts= (1/ratio) * PTS to speed up? No.
+        # video_ratio = target / source. 
+        # If target (4s) > source (2s), ratio = 2.0. We need to SLOW DOWN.
+        # setpts=2.0*PTS makes it 2x longer. Correct.
+        pingpong_mem = None if video_ratio <= 1.5 else pingpong_bytes(video_path, video_duration, probe_cache)
+        if video_ratio <= 1.5:
+             v_in = add_input(inputs, video_path, **codec_settings['input'])
+             v_src = f"[{v_in}:v:0]"
+             # Case 2: Small gap (>1.0, <=1.5). Slow down video.
+             # Force duration match by changing PTS
+             print(f"Segment {index}: Apply SLOW DOWN (Ratio {video_ratio:.2f})", file=sys.stderr)
+             # setpts=RATIO*PTS slows it down
+             vf.append(filter_spec('setpts', f"{video_ratio}*PTS"))
+             # Ensure exact trim
+             vf.append(filter_spec('trim', duration=final_duration))
+        elif pingpong_mem is not None and pingpong_mem > PINGPONG_MAX_BYTES:
+             # Case 4: Large gap, but too many frames to hold for ping-pong. Replay
+             # the clip forward with -stream_loop: it is re-read instead of buffered.
+             print(f"Segment {index}: Apply LOOP (Ratio {video_ratio:.2f}, ping-pong would buffer ~{pingpong_mem >> 20} MB)", file=sys.stderr)
+             v_in = add_input(inputs, video_path, stream_loop=-1, t=final_duration, **codec_settings['input'])
+             v_src = f"[{v_in}:v:0]"
+        else:
+             v_in = add_input(inputs, video_path, **codec_settings['input'])
+             v_src = f"[{v_in}:v:0]"
+             # Case 3: Large gap (>1.5). Ping-Pong Loop.
+             print(f"Segment {index}: Apply PING-PONG LOOP (Ratio {video_ratio:.2f})", file=sys.stderr)
+             
+             # Create Reverse
+             # [0] split [v_fwd] [v_rev_pre]
+             graph.append(f"{v_src}split[fwd{index}][rev{index}]")
+             graph.append(f"[rev{index}]reverse[revd{index}]")
+             
+             # Concat Forward + Reverse
+             # [v_fwd][v_rev] concat=n=2:v=1:a=0
+             v_src = f"[fwd{index}][revd{index}]"
+             vf.append('concat=n=2:v=1:a=0')
+             
+             # Loop this specific ping-pong sequence indefinitely
+             # Then trim to final duration
+             vf.append(filter_spec('loop', loop=-1, size=32767, start=0))
+             vf.append(filter_spec('trim', duration=final_duration))
+             vf.append('setpts=PTS-STARTPTS')
+
+    # Common Cleanup: Scale/Pad/Format, only the steps the source actually needs.
+    # Slowed-down clips (setpts) always go through fps to get back onto 30fps.
+    if not copy_video:
+        needs_scale, needs_fps, needs_fmt = conform_steps(video_path, width, height, probe_cache)
+        retimed = video_duration < target_duration and video_ratio <= 1.5
+        vf.append(conform_chain(width, height, needs_scale, needs_fps or retimed, needs_fmt))
+
+    # 2. AUDIO PIPELINE
+    # Time-stretching logic
+    af = []
+    if audio_path:
+        a_in = add_input(inputs, audio_path)
+    else:
+        # Silent segment: endless lavfi silence, cut to length by the atrim below.
+        a_in = add_input(inputs, f'anullsrc=channel_layout=stereo:sample_rate={AUDIO_SAMPLE_RATE}', f='lavfi')
+
+    # Check if we need to stretch (ratio-based, see TEMPO_TOLERANCE)
+    tempo = stretch_tempo(input_audio_duration, target_duration)
+    if tempo:
+        print(f"Segment {index}: Audio Time-Stretch required. Input={input_audio_duration}, Target={target_duration}, Tempo={tempo:.2f}", file=sys.stderr)
+
+        if ffmpeg_caps().has_filter('rubberband'):
+            # One phase-vocoder pass at any ratio, cleaner on speech than WSOLA.
+            af.append(filter_spec('rubberband', tempo=f'{tempo:.6f}', pitchq='quality'))
+        else:
+            af.extend(atempo_chain(tempo))
+
+    # Pad/Trim to exact final duration to be safe
+    # Every segment leaves with the same rate/layout so the concat demuxer sees one
+    # uniform audio format and no resample is needed when joining.
+    # aresample (async=1, first_pts=0) fills any gap the tempo chain leaves at the
+    # start and asetpts rebases to 0, so the sample-exact atrim below counts from
+    # the segment's first sample and every seam lands on the same sample.
+    af.append(filter_spec('aresample', AUDIO_SAMPLE_RATE, **{'async': 1, 'first_pts': 0}))
+    af.append(filter_spec('aformat', sample_rates=AUDIO_SAMPLE_RATE, channel_layouts='stereo'))
+    af.append('asetpts=PTS-STARTPTS')
+    af.append('apad')
+    af.append(filter_spec('atrim', end_sample=round(final_duration * AUDIO_SAMPLE_RATE)))
+    graph.append(f"[{a_in}:a:0]{','.join(af)}[a{index}]")
+
+    # 3. SUBTITLES (Existing Logic Preserved)
+    # 3. SUBTITLES (Existing Logic Preserved)
+    if text and include_subtitles and not copy_video:
+        clean_text = _BRACKET_RE.sub('', text).translate(_DASH_TO_SPACE)
+        clean_text = _WS_RE.sub(' ', clean_text).strip()
+        alignment = segment.get('alignment')
+
+        # Calculate Subtitle Scale Factor (match Audio Pipeline logic)
+        subtitle_scale = 1.0
+        if tempo:
+             subtitle_scale = target_duration / input_audio_duration
+             print(f"Segment {index}: Scaling Subtitles by {subtitle_scale:.4f} (Input={input_audio_duration} -> Target={target_duration})", file=sys.stderr)
         
-        # Smart Stitching Logic
-        # Calculate audio/video ratio to decide strategy
-        # Video ratio: If we want video to fit target.
-        # We already handle video stretching below based on `target_duration` vs `video_duration`.
-        video_ratio = target_duration / video_duration if video_duration > 0 else 1.0
-        print(f"Segment {index}: Ratio Video: {video_ratio:.2f}", file=sys.stderr)
-
-        # 1. VIDEO PIPELINE
-        in_video = ffmpeg.input(video_path)
-
-        if video_duration >= target_duration:
-            # Case 1: Video is long enough. Just trim.
-            # Loop just in case of slight precision errors, then trim.
-            v = in_video.filter('trim', duration=final_duration).filter('setpts', 'PTS-STARTPTS')
+        font_path = font_settings.get('font')
+        # main() resolves the font once (see resolve_font); only stat when a caller didn't.
+        font_is_file = font_settings.get('font_is_file')
+        if font_is_file is None:
+            font_path, font_is_file = resolve_font(font_path)
+
+        base_drawtext = {
+            'fontsize': font_settings.get('fontsize', 70),
+            'fontcolor': 'white',
+            'borderw': 0,
+            'bordercolor': 'black',
+            'shadowcolor': 'black',
+            'shadowx': 0,
+            'shadowy': 0,
+            'box': 1,
+            'boxcolor': 'black@1.0',
+            'boxborderw': 20,
+            'x': '(w-text_w)/2',
+            'y': font_settings.get('y_pos', '(h-text_h)/1.2'),
+        }
         
+        if font_is_file:
+            base_drawtext['fontfile'] = font_path
         else:
-            # Video is shorter. Smart Loop.
-            # Use video_ratio. Atempo logic for video is `setpts`. 
-            # setpts= (1/ratio) * PTS to speed up? No.
-            # video_ratio = target / source. 
-            # If target (4s) > source (2s), ratio = 2.0. We need to SLOW DOWN.
-            # setpts=2.0*PTS makes it 2x longer. Correct.
-            if video_ratio <= 1.5:
-                 # Case 2: Small gap (>1.0, <=1.5). Slow down video.
-                 # Force duration match by changing PTS
-                 print(f"Segment {index}: Apply SLOW DOWN (Ratio {video_ratio:.2f})", file=sys.stderr)
-                 # setpts=RATIO*PTS slows it down
-                 v = in_video.filter('setpts', f"{video_ratio}*PTS")
-                 # Ensure exact trim
-                 v = v.filter('trim', duration=final_duration)
-            else:
-                 # Case 3: Large gap (>1.5). Ping-Pong Loop.
-                 print(f"Segment {index}: Apply PING-PONG LOOP (Ratio {video_ratio:.2f})", file=sys.stderr)
-                 
-                 # Create Reverse
-                 # [0] split [v_fwd] [v_rev_pre]
-                 split = in_video.split()
-                 v_fwd = split[0]
-                 v_rev = split[1].filter('reverse')
-                 
-                 # Concat Forward + Reverse
-                 # [v_fwd][v_rev] concat=n=2:v=1:a=0
-                 ping_pong = ffmpeg.concat(v_fwd, v_rev, v=1, a=0)
-                 
-                 # Loop this specific ping-pong sequence indefinitely
-                 # Then trim to final duration
-                 v = ping_pong.filter('loop', loop=-1, size=32767, start=0)
-                 v = v.filter('trim', duration=final_duration).filter('setpts', 'PTS-STARTPTS')
-
-        # Common Cleanup: Scale/Pad/Format
-        v = v.filter('scale', width, height, force_original_aspect_ratio='decrease')
-        v = v.filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
-        v = v.filter('setsar', '1')
-        v = v.filter('fps', fps=30)
-        v = v.filter('format', 'yuv420p')
-
-        # 2. AUDIO PIPELINE
-        # Time-stretching logic
-        in_audio = ffmpeg.input(audio_path)
-        a = in_audio
-
-        if input_audio_duration > 0 and target_duration > 0:
-            # Check if we need to stretch
-            # Tolerance: 0.1s
-            if abs(input_audio_duration - target_duration) > 0.1:
-                tempo = input_audio_duration / target_duration
-                print(f"Segment {index}: Audio Time-Stretch required. Input={input_audio_duration}, Target={target_duration}, Tempo={tempo:.2f}", file=sys.stderr)
-                
-                # Constraint: 0.5 <= tempo <= 2.0
-                # If outside, we chain.
-                # Simple chaining:
-                while tempo > 2.0:
-                    a = a.filter('atempo', '2.0')
-                    tempo /= 2.0
-                while tempo < 0.5:
-                    a = a.filter('atempo', '0.5')
-                    tempo /= 0.5
-                
-                # Apply remaining
-                a = a.filter('atempo', str(tempo))
-
-        # Pad/Trim to exact final duration to be safe
-        a = a.filter('apad').filter('atrim', duration=final_duration)
-
-        # 3. SUBTITLES (Existing Logic Preserved)
-        # 3. SUBTITLES (Existing Logic Preserved)
-        if text and include_subtitles:
-            clean_text = re.sub(r'\[.*?\]', '', text).replace('--', ' ').replace('-', ' ')
-            clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-            alignment = segment.get('alignment')
-
-            # Calculate Subtitle Scale Factor (match Audio Pipeline logic)
-            subtitle_scale = 1.0
-            if input_audio_duration > 0 and target_duration > 0:
-                 if abs(input_audio_duration - target_duration) > 0.1:
-                      subtitle_scale = target_duration / input_audio_duration
-                      print(f"Segment {index}: Scaling Subtitles by {subtitle_scale:.4f} (Input={input_audio_duration} -> Target={target_duration})", file=sys.stderr)
-            
-            font_path = font_settings.get('font')
-            # Fallback if font missing
-            if not os.path.exists(font_path) and font_path != 'Arial':
-                 font_path = 'Arial'
-
-            base_drawtext = {
-                'fontsize': font_settings.get('fontsize', 70),
-                'fontcolor': 'white',
-                'borderw': 0,
-                'bordercolor': 'black',
-                'shadowcolor': 'black',
-                'shadowx': 0,
-                'shadowy': 0,
-                'box': 1,
-                'boxcolor': 'black@1.0',
-                'boxborderw': 20,
-                'x': '(w-text_w)/2',
-                'y': font_settings.get('y_pos', '(h-text_h)/1.2'),
-            }
-            
-            if os.path.exists(font_path):
-                base_drawtext['fontfile'] = font_path
-            else:
-                base_drawtext['font'] = font_path
-
-            if alignment:
-                # Precise alignment logic
-                chars = alignment.get('characters', [])
-                starts = alignment.get('character_start_times_seconds', [])
-                ends = alignment.get('character_end_times_seconds', [])
-                
-                # Simple word aggregator
-                current_word = ""
-                w_start = -1
-                w_end = -1
-                
-                for i, char in enumerate(chars):
-                    if char in ['[', ']']: continue # rudimentary skip
-                    
-                    if char == ' ':
-                        if current_word.strip():
-                            safe_word = current_word.strip().replace("'", "\\'").replace(":", "\\:")
-                            dt = base_drawtext.copy()
-                            dt['text'] = safe_word
-                            # Apply Scaling
-                            dt['enable'] = f'between(t,{w_start},{w_end})'
-                            v = v.drawtext(**dt)
-                        current_word = ""
-                        w_start = -1
-                    else:
-                        if w_start == -1: 
-                            w_start = starts[i] * subtitle_scale
-                        w_end = ends[i] * subtitle_scale
-                        current_word += char
-                
-                # Last word
-                if current_word.strip():
-                    safe_word = current_word.strip().replace("'", "\\'").replace(":", "\\:")
-                    dt = base_drawtext.copy()
-                    dt['text'] = safe_word
-                    dt['enable'] = f'between(t,{w_start},{w_end})'
-                    v = v.drawtext(**dt)
+            base_drawtext['font'] = font_path
+
+        # (word, start, end) in output-timeline seconds
+        words_with_timing = []
+        if alignment:
+            # Precise alignment logic
+            chars, starts, ends = alignment_arrays(alignment)
+            words_with_timing = words_from_alignment(chars, starts, ends, subtitle_scale)
+        else:
+            # Even distribution fallback
+            words = clean_text.split()
+            if words:
+                # Duration for text distribution should match audio length, NOT video padding
+                # But we don't have raw audio length easily here without probing. 
+                # Approximation: Use target_duration * 0.9 to avoid text in silence?
+                # Better: Probe audio file in Python before this. 
+                # For now, spread across 90% of duration to be safe.
+                w_dur = (target_duration * 0.9) / len(words)
+                for i, word in enumerate(words):
+                    words_with_timing.append((word, i*w_dur, (i+1)*w_dur))
+
+        # Both are libass; `subtitles` also reads other formats, so prefer `ass`.
+        ass_filter = next((f for f in ('ass', 'subtitles') if ffmpeg_caps().has_filter(f)), None)
+        fontsize = base_drawtext['fontsize']
+        y_top = None
+        if words_with_timing and ass_filter:
+            # The ASS script needs --y_pos in pixels; drawtext evaluates it per frame,
+            # so positions only it understands (if(), max()...) go the drawtext way.
+            # Every drawtext alias is a constant here: text_w is 0 (centred anyway).
+            try:
+                y_top = eval_position_expr(
+                    base_drawtext['y'], w=width, h=height, W=width, H=height,
+                    main_w=width, main_h=height, text_w=0, tw=0, text_h=fontsize, th=fontsize,
+                )
+            except ValueError as e:
+                print(f"Segment {index}: {e}; using drawtext", file=sys.stderr)
+        if y_top is not None:
+            # One libass pass for every word: glyphs are rasterized once and cached,
+            # where a drawtext chain adds a filter (and a frame walk) per word.
+            ass_path = os.path.join(asset_dir, f"{asset_prefix}.ass")
+            ass_kwargs = {}
+            if font_is_file:
+                ass_font = font_family(font_path)
+                ass_kwargs['fontsdir'] = os.path.dirname(os.path.abspath(font_path))
+                ass_fontsize = fontsize * ass_font_scale(font_path)
             else:
-                # Even distribution fallback
-                words = clean_text.split()
-                if words:
-                    # Duration for text distribution should match audio length, NOT video padding
-                    # But we don't have raw audio length easily here without probing. 
-                    # Approximation: Use target_duration * 0.9 to avoid text in silence?
-                    # Better: Probe audio file in Python before this. 
-                    # For now, spread across 90% of duration to be safe.
-                    w_dur = (target_duration * 0.9) / len(words)
-                    for i, word in enumerate(words):
-                        safe_word = word.replace("'", "\\'").replace(":", "\\:")
-                        dt = base_drawtext.copy()
-                        dt['text'] = safe_word
-                        dt['enable'] = f'between(t,{i*w_dur},{(i+1)*w_dur})'
-                        v = v.drawtext(**dt)
+                ass_font = font_path
+                ass_fontsize = fontsize * ASS_DEFAULT_FONT_SCALE
+            # Same glyph size as the --fontsize drawtext would draw.
+            write_ass(ass_path, words_with_timing, width, height, ass_font, round(ass_fontsize, 1), base_drawtext['boxborderw'], int(y_top))
+            assets.append(ass_path)
+            vf.append(filter_spec(ass_filter, ass_path, **ass_kwargs))
+        else:
+            # filter_spec escapes the text for the graph; no pre-quoting needed.
+            for word, w_start, w_end in words_with_timing:
+                dt = base_drawtext.copy()
+                dt['text'] = word
+                dt['enable'] = f'between(t,{w_start},{w_end})'
+                vf.append(filter_spec('drawtext', **dt))
+
+    if copy_video:
+        v = f"{v_in}:v:0"
+    else:
+        graph.append(f"{v_src}{','.join(vf)}[v{index}]")
+        v = f"[v{index}]"
+    return graph, v, f"[a{index}]", final_duration, assets
 
+def can_copy_video(segment, durations, width, height, include_subtitles=True, probe_cache=None):
+    """True if a segment's video can go into its temp file without a re-encode.
+
+    Needs no burned-in text, no retiming (the clip covers the target duration)
+    and a clip already in the output format. Whether the job can use it is
+    decided across all segments (see copy_video_plan).
+    """
+    if segment.get('text') and include_subtitles:
+        return False
+    # A missing duration is reported by build_segment_graph.
+    if segment.get('duration') is None:
+        return False
+    if durations is None:
+        durations = probe_segment_durations(segment, probe_cache)
+    if durations[0] < segment['duration']:
+        return False
+    try:
+        return video_conforms(segment['video'], width, height, probe_cache)
+    except Exception:
+        return False
+
+def copy_video_plan(segments, durations, width, height, include_subtitles=True, probe_cache=None):
+    """Per-segment copy_video flags for --per_segment: all True or all False.
+
+    Copied packets keep their source's profile, SPS/PPS and time base, which an
+    encoded segment next to them won't share, and the concat demuxer can't join
+    mismatched streams (wrong duration, broken timestamps). So video is only
+    copied when every segment qualifies and all of them share copy_params.
+    """
+    try:
+        if all(can_copy_video(seg, d, width, height, include_subtitles, probe_cache) for seg, d in zip(segments, durations)):
+            params = {copy_params(seg['video'], probe_cache) for seg in segments}
+            if len(params) == 1 and None not in params:
+                return [True] * len(segments)
+    except Exception:
+        pass
+    return [False] * len(segments)
+
+def video_encoder_args(encoder, preset=None, per_segment=False):
+    """-c:v plus the ENCODER_SETTINGS output options, with --preset applied.
+
+    `per_segment` layers on the encoder's 'segment_output' overrides, if any.
+    --preset takes libx264 preset names, so hardware encoders keep their own
+    (NVENC rejects 'veryfast', VideoToolbox has no preset option).
+    """
+    settings = ENCODER_SETTINGS[encoder]
+    options = dict(settings['output'])
+    if per_segment:
+        options.update(settings.get('segment_output', {}))
+    if preset and encoder == 'libx264':
+        options['preset'] = preset
+    return ['-c:v', encoder, *option_args(options)]
+
+def remove_files(paths):
+    """Delete temp files, ignoring ones that are already gone (one syscall each)."""
+    for p in paths:
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
+
+def _init_worker(hw_sessions, caps):
+    """ProcessPoolExecutor initializer; semaphores can't travel as task arguments.
+
+    Also seeds the capability cache so workers don't re-run ffmpeg -filters.
+    """
+    global _hw_sessions, _CAPS
+    _hw_sessions = hw_sessions
+    _CAPS = caps
+
+def process_segment(segment, index, output_path, width, height, font_settings, include_subtitles=True, threads=THREADS_PER_JOB, encoder='libx264', durations=None, preset=None, copy_video=False, probe_cache=None):
+    inputs = []
+    graph, v, a, final_duration, assets = build_segment_graph(segment, index, width, height, font_settings, inputs, include_subtitles, encoder, durations, os.path.dirname(output_path), copy_video, probe_cache)
+    if copy_video:
+        video_args = ['-c:v', 'copy']
+    else:
+        # The join stream-copies these files, so each must open on a keyframe
+        # whatever the encoder's GOP settings are.
+        video_args = [*video_encoder_args(encoder, preset, per_segment=True), '-force_key_frames', 'expr:eq(n,0)']
+
+    try:
         # 4. OUTPUT
-        out = ffmpeg.output(
-            v, a, output_path,
-            vcodec='libx264', acodec='aac',
-            audio_bitrate='192k', video_bitrate='4000k',
-            preset='fast', pix_fmt='yuv420p',
-            t=final_duration, # Redundant but safe
-            loglevel='error'
-        )
-        out.run(overwrite_output=True)
+        # Segments are stream-copied into the final file, so this is the only video
+        # encode: constant quality with a fast preset (see ENCODER_SETTINGS). The
+        # filter graph gets the same thread budget as the encoder; ffmpeg would
+        # otherwise run scale/pad/subtitles on a single thread. No output -t: every
+        # video path already stops at final_duration (input -t or trim) and the
+        # audio ends on atrim.
+        cmd = ffmpeg_command(inputs, graph, [v, a], [
+            *video_args,
+            '-c:a', 'aac', '-b:a', '192k',
+            '-threads', str(threads),
+        ], output_path, global_args=['-filter_complex_threads', str(threads)])
+        # Only hardware encodes take an NVENC session; copied video and libx264 don't.
+        uses_session = not copy_video and encoder == 'h264_nvenc' and _hw_sessions is not None
+        with _hw_sessions if uses_session else contextlib.nullcontext():
+            run_ffmpeg(cmd)
 
     except Exception as e:
         print(f"Error processing segment {index}: {e}", file=sys.stderr)
         raise
+    finally:
+        remove_files(assets)
+
+def mix_music(audio_pad, args, inputs, graph):
+    """Mix the --audio background track under `audio_pad`; returns the mixed pad."""
+    input_kwargs = {}
+    if args.music_start_time > 0:
+        input_kwargs['ss'] = args.music_start_time
+    
+    music = add_input(inputs, args.audio, **input_kwargs)
+    graph.append(f"[{music}:a:0]{filter_spec('volume', args.volume)}[bgm]")
+    # amix duration=first ensures we stop when video stops
+    graph.append(f"{audio_pad}[bgm]amix=inputs=2:duration=first:dropout_transition=2[mixed]")
+    return '[mixed]'
+
+def render_single_pass(segments, durations, args, width, height, font_settings, encoder, has_music, work_dir, probe_cache=None):
+    """Render every segment through one ffmpeg graph joined by the concat filter.
+
+    No intermediate files and a single process/encoder setup, at the cost of
+    encoding the whole timeline in one process rather than a worker pool.
+    """
+    inputs = []
+    graph = []
+    pads = []
+    assets = []
+    boundaries = []
+    position = 0.0
+    for i, seg in enumerate(segments):
+        seg_graph, v, a, seg_duration, seg_assets = build_segment_graph(seg, i, width, height, font_settings, inputs, not args.no_subtitles, encoder, durations[i], work_dir, probe_cache=probe_cache)
+        graph.extend(seg_graph)
+        pads.extend((v, a))
+        assets.extend(seg_assets)
+        boundaries.append(position)
+        position += seg_duration
+
+    graph.append(f"{''.join(pads)}concat=n={len(segments)}:v=1:a=1[outv][outa]")
+    audio_pad = '[outa]'
+
+    # Mix Background Music
+    if has_music:
+        audio_pad = mix_music(audio_pad, args, inputs, graph)
+
+    # Keyframe at every segment start, so cuts and seeks land on clean frames.
+    # With no worker pool, the graph's filters get every core (the default is one
+    # thread for the whole -filter_complex), as does the encoder via -threads 0.
+    cpu_count = os.cpu_count() or 4
+    cmd = ffmpeg_command(inputs, graph, ['[outv]', audio_pad], [
+        *video_encoder_args(encoder, args.preset),
+        '-force_key_frames', ','.join(f"{t:.3f}" for t in boundaries),
+        '-c:a', 'aac', '-b:a', '192k',
+        '-threads', '0',
+    ], args.output, global_args=['-filter_complex_threads', str(cpu_count)])
+    try:
+        run_ffmpeg(cmd)
+    finally:
+        remove_files(assets)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -259,6 +1026,11 @@ def main():
     parser.add_argument("--volume", type=float, default=0.3)
     parser.add_argument("--music_start_time", type=float, default=0.0)
     parser.add_argument("--no_subtitles", action="store_true")
+    parser.add_argument("--hwaccel", choices=["none", "auto", *HW_ENCODERS], default="auto", help="Video encoder: a working NVENC/QSV/VideoToolbox encoder (auto), a specific one, or libx264 (none). With auto, a machine with a usable GPU encodes at NVENC cq 23 (QSV global_quality 23, VideoToolbox 4 Mb/s) rather than libx264 CRF 18")
+    parser.add_argument("--preset", default=None, help="libx264 preset, overriding the default (veryfast; ultrafast for --per_segment). Ignored by hardware encoders")
+    parser.add_argument("--per_segment", action="store_true", help="Encode each segment in its own ffmpeg worker and stream-copy join them, instead of one single-pass graph")
+    parser.add_argument("--jobs", type=int, default=None, help="--per_segment: segments encoded concurrently (default: cpu_count // threads per job)")
+    parser.add_argument("--threads_per_job", type=int, default=None, help="--per_segment: ffmpeg threads per segment encode (default: cpu_count // jobs)")
     args = parser.parse_args()
 
     # Resolution
@@ -272,8 +1044,11 @@ def main():
     work_dir = os.path.abspath(args.temp_dir) if args.temp_dir else os.getcwd()
     os.makedirs(work_dir, exist_ok=True)
     
+    font, font_is_file = resolve_font(args.font)
+
     font_settings = {
-        'font': args.font,
+        'font': font,
+        'font_is_file': font_is_file,
         'fontsize': args.fontsize,
         'color': args.color,
         'y_pos': args.y_pos
@@ -286,74 +1061,140 @@ def main():
 
     print(f"Stitching {len(segments)} segments...", file=sys.stderr)
 
+    caps = ffmpeg_caps()
+    print(f"Using {caps.version}", file=sys.stderr)
+    encoder = caps.best_h264_encoder(args.hwaccel)
+    if args.preset and encoder != 'libx264':
+        print(f"Warning: --preset applies to libx264 only; {encoder} keeps its default", file=sys.stderr)
+    has_music = bool(args.audio and os.path.exists(args.audio))
+
+    # Fail before any encode starts, naming every bad input at once.
+    missing = missing_inputs(segments)
+    if missing:
+        raise FileNotFoundError("Missing segment inputs:\n" + "\n".join(missing))
+
+    # Probe every input file once, up front, instead of serially inside each worker.
+    # Videos are always probed: besides the duration, the graph needs their stream
+    # info (pingpong_bytes, conform_steps, can_copy_video). Audio whose length is in
+    # the manifest or an alignment needs no probe (see probe_segment_durations).
+    probe_paths = []
+    for seg in segments:
+        probe_paths.append(seg['video'])
+        if seg.get('audio_duration_s') is None and not (seg.get('alignment') or {}).get('character_end_times_seconds'):
+            probe_paths.append(seg.get('audio'))
+    probe_cache = probe_all(probe_paths)
+    durations = [probe_segment_durations(seg, probe_cache) for seg in segments]
+
+    # Default: one ffmpeg process, one encode, no intermediate files.
+    if not args.per_segment and len(segments) > SINGLE_PASS_MAX_SEGMENTS:
+        print(f"Warning: {len(segments)} segments exceeds the single-pass limit ({SINGLE_PASS_MAX_SEGMENTS}), encoding per segment", file=sys.stderr)
+        args.per_segment = True
+    if not args.per_segment:
+        print(f"Stitching {len(segments)} segments in a single pass (Encoder: {encoder})...", file=sys.stderr)
+        render_single_pass(segments, durations, args, W, H, font_settings, encoder, has_music, work_dir, probe_cache)
+        print(args.output) # Return path to Node
+        return
+
     # Process Segments
     # Pre-allocate list to maintain order
     temp_files = [None] * len(segments) 
     
-    import concurrent.futures
-    # Determine workers: use CPU count but cap at 4 to avoid OOM/Swap death on smaller instances
-    # Each worker spawns an ffmpeg process, so 4 workers = 4 ffmpeg processes.
-    max_workers = min(os.cpu_count() or 4, 4)
-    
-    print(f"Stitching {len(segments)} segments in parallel (Workers: {max_workers})...", file=sys.stderr)
+    # Determine workers: each worker drives one ffmpeg process capped at threads_per_job
+    # threads, so total encoder threads stay close to the core count instead of
+    # N processes each grabbing every core (ffmpeg's default).
+    cpu_count = os.cpu_count() or 4
+    if args.threads_per_job:
+        threads_per_job = args.threads_per_job
+    elif args.jobs:
+        threads_per_job = max(1, cpu_count // args.jobs)
+    else:
+        threads_per_job = THREADS_PER_JOB
+    jobs = args.jobs or max(1, cpu_count // threads_per_job)
+    max_workers = max(1, min(jobs, len(segments)))
+    # Workers aren't capped for NVENC; a shared semaphore holds the encodes to the
+    # card's session limit while stream-copied segments keep going.
+    # forkserver workers start from a clean interpreter instead of a fork of this
+    # one (open files, probe threads); fall back where it isn't available.
+    mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None)
+    hw_sessions = mp_context.Semaphore(NVENC_MAX_SESSIONS) if encoder == 'h264_nvenc' else None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_index = {}
-        for i, seg in enumerate(segments):
-            out_name = os.path.join(work_dir, f"seg_{session_id}_{i}.mp4")
-            future = executor.submit(process_segment, seg, i, out_name, W, H, font_settings, not args.no_subtitles)
-            future_to_index[future] = (i, out_name)
+    print(f"Stitching {len(segments)} segments in parallel (Workers: {max_workers}, Threads/job: {threads_per_job}, Encoder: {encoder})...", file=sys.stderr)
 
-        for future in concurrent.futures.as_completed(future_to_index):
-            i, out_name = future_to_index[future]
+    # Processes rather than threads: the filter-graph construction in process_segment
+    # is pure Python and would otherwise serialize on the GIL.
+    seg_paths = [os.path.join(work_dir, f"seg_{session_id}_{i}.mp4") for i in range(len(segments))]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_worker, initargs=(hw_sessions, caps)) as executor:
             try:
-                future.result()
-                temp_files[i] = out_name
-                print(f"Segment {i} finished.", file=sys.stderr)
-            except Exception as exc:
-                print(f"Segment {i} generated an exception: {exc}", file=sys.stderr)
-                # Cancel remaining?
-                raise exc
+                future_to_index = {}
+                # Decided here, from the shared probes, so workers never run ffprobe.
+                copy_flags = copy_video_plan(segments, durations, W, H, not args.no_subtitles, probe_cache)
+                for i, seg in enumerate(segments):
+                    out_name = seg_paths[i]
+                    copy_video = copy_flags[i]
+                    video_key = os.path.abspath(seg['video'])
+                    seg_probes = {video_key: probe_cache[video_key]} if video_key in probe_cache else None
+                    future = executor.submit(process_segment, seg, i, out_name, W, H, font_settings, not args.no_subtitles, threads_per_job, encoder, durations[i], args.preset, copy_video, seg_probes)
+                    future_to_index[future] = (i, out_name)
+
+                for future in concurrent.futures.as_completed(future_to_index):
+                    i, out_name = future_to_index[future]
+                    try:
+                        future.result()
+                        temp_files[i] = out_name
+                        print(f"Segment {i} finished.", file=sys.stderr)
+                    except Exception as exc:
+                        print(f"Segment {i} generated an exception: {exc}", file=sys.stderr)
+                        raise exc
+            except BaseException:
+                # A failed segment or Ctrl-C: drop queued segments instead of encoding them
+                # all before the error surfaces.
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    except BaseException:
+        # Don't leave finished (or half-written) segments behind in work_dir.
+        remove_files(seg_paths)
+        raise
     
     # Ensure no Nones (should be covered by exception raise above)
     temp_files = [f for f in temp_files if f]
 
+    # Fast path: a lone segment with nothing to mix already is the final file.
+    if len(temp_files) == 1 and not has_music:
+        shutil.move(temp_files[0], args.output)
+        print(args.output) # Return path to Node
+        return
+
     # Concat
-    list_path = os.path.join(work_dir, f"inputs_{session_id}.txt")
-    with open(list_path, 'w') as f:
-        for p in temp_files:
-            f.write(f"file '{p}'\n")
+    # Every segment comes out of the same conform chain and encoder settings, so the
+    # concat demuxer can join them with stream copy instead of a decode/encode pass.
+    # The list goes to ffmpeg over stdin, so nothing is written to disk for it.
+    concat_list = []
+    for p in temp_files:
+        # Concat demuxer quoting: close the quote, emit an escaped quote, reopen.
+        # The explicit file: protocol stops paths resolving against the pipe: URL.
+        escaped = os.path.abspath(p).replace("'", "'\\''")
+        concat_list.append(f"file 'file:{escaped}'\n")
 
     try:
-        input_args = {'f': 'concat', 'safe': 0}
-        concat = ffmpeg.input(list_path, **input_args)
-        
-        video_stream = concat.video
-        audio_stream = concat.audio
+        inputs = []
+        graph = []
+        add_input(inputs, 'pipe:0', f='concat', safe=0, protocol_whitelist='file,pipe')
+        audio_stream = '0:a:0'
 
         # Mix Background Music
-        if args.audio and os.path.exists(args.audio):
-            input_kwargs = {}
-            if args.music_start_time > 0:
-                input_kwargs['ss'] = args.music_start_time
-            
-            bgm = ffmpeg.input(args.audio, **input_kwargs).filter('volume', args.volume)
-            # amix duration=first ensures we stop when video stops
-            audio_stream = ffmpeg.filter([audio_stream, bgm], 'amix', duration='first', dropout_transition=2)
+        if has_music:
+            audio_stream = mix_music('[0:a:0]', args, inputs, graph)
 
         # Final Render
-        out = ffmpeg.output(
-            video_stream, audio_stream, args.output,
-            vcodec='copy', acodec='aac', audio_bitrate='192k',
-            loglevel='error'
-        )
-        out.run(overwrite_output=True)
+        # Segment audio is already AAC; only re-encode when music was mixed in.
+        audio_args = ['-c:a', 'aac', '-b:a', '192k'] if has_music else ['-c:a', 'copy']
+        cmd = ffmpeg_command(inputs, graph, ['0:v:0', audio_stream], ['-c:v', 'copy', *audio_args], args.output)
+        run_ffmpeg(cmd, ''.join(concat_list).encode())
         print(args.output) # Return path to Node
 
     finally:
-        if os.path.exists(list_path): os.remove(list_path)
-        for p in temp_files:
-            if os.path.exists(p): os.remove(p)
+        remove_files(temp_files)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stitch_clips
+
+def check(name, got, expected):
+    # Raises, so a failed check fails under pytest as well as when run directly.
+    assert got == expected, f"{name}: got {got!r}, expected {expected!r}"
+
+def words(text, scale=1.0):
+    # One character per alignment entry, each lasting one second.
+    n = len(text)
+    chars = np.asarray(list(text), dtype=str)
+    starts = np.arange(n, dtype=np.float32)
+    return stitch_clips.words_from_alignment(chars, starts, starts + 1, scale)
+
+def test_words_from_alignment():
+    check("plain words", words("hi there"), [("hi", 0.0, 2.0), ("there", 3.0, 8.0)])
+    check("scaled timing", words("hi", 0.5), [("hi", 0.0, 1.0)])
+    check("tag dropped", [w for w, _, _ in words("[laughs] hi there")], ["hi", "there"])
+    check("nested tag dropped", [w for w, _, _ in words("x [a [b] c] y")], ["x", "y"])
+    # Unclosed '[' is skipped like a stray character; the text after it stays.
+    check("unclosed bracket", [w for w, _, _ in words("[unclosed hello")], ["unclosed", "hello"])
+    # A stray ']' must not let a later '[' through.
+    check("stray close", [w for w, _, _ in words("a]b [c d")], ["ab", "c", "d"])
+    check("only tags", words("[] [x]"), [])
+    check("empty", words(""), [])
+
+def test_filter_escaping():
+    check("filter_arg", stitch_clips.filter_arg("it's a:b,c;d[e]\\x"), "it\\\\\\'s a\\\\:b\\,c\\;d\\[e\\]\\\\\\\\x")
+    check("filter_spec positional", stitch_clips.filter_spec('pad', 1080, 1920, '(ow-iw)/2', '(oh-ih)/2'), "pad=1080:1920:(ow-iw)/2:(oh-ih)/2")
+    check("filter_spec keyword", stitch_clips.filter_spec('drawtext', text='a:b', enable='between(t,0,1)'), "drawtext=text=a\\\\:b:enable=between(t\\,0\\,1)")
+    check("filter_spec bare", stitch_clips.filter_spec('reverse'), "reverse")
+
+    # Round trip through ffmpeg's own parsers: metadata=print echoes the value back.
+    if shutil.which('ffmpeg') is None:
+        print("ffmpeg not found, skipping the escaping round trip")
+        return
+    value = "it's a:b,c;d[e]\\x=y"
+    graph = ','.join([
+        'color=c=black:s=16x16:d=0.04',
+        stitch_clips.filter_spec('metadata', mode='add', key='k', value=value),
+        'metadata=mode=print',
+    ])
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-filter_complex', graph, '-f', 'null', '-'], capture_output=True, text=True)
+    printed = next((line.split('k=', 1)[1] for line in result.stderr.splitlines() if 'k=' in line), None)
+    check("ffmpeg round trip", printed, value)
+
+def test_atempo_chain():
+    check("single stage", stitch_clips.atempo_chain(1.3), ["atempo=1.300000"])
+    check("lower bound", stitch_clips.atempo_chain(0.5), ["atempo=0.500000"])
+    check("split speed-up", stitch_clips.atempo_chain(4.5), ["atempo=1.650964"] * 3)
+    check("split slow-down", stitch_clips.atempo_chain(0.2), ["atempo=0.584804"] * 3)
+
+def test_stretch_tempo():
+    check("within 1%", stitch_clips.stretch_tempo(600.0, 600.15), None)
+    check("stretch", stitch_clips.stretch_tempo(2.0, 1.6), 1.25)
+    check("no audio", stitch_clips.stretch_tempo(0, 2.0), None)
+    try:
+        stitch_clips.stretch_tempo(876.0, 1.0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("out of range: expected ValueError")
+
+if __name__ == "__main__":
+    test_words_from_alignment()
+    test_filter_escaping()
+    test_atempo_chain()
+    test_stretch_tempo()
+    print("All checks passed!")
@@ -4,16 +4,14 @@ import json
 import sys
 
 def create_dummy_assets():
-    # Create dummy video (2 seconds, black)
+    # One ffmpeg run writes both: dummy video (2 seconds, black) and
+    # dummy audio (2 seconds, sine wave)
     subprocess.run([
-        'ffmpeg', '-y', '-f', 'lavfi', '-i', 'color=c=black:s=720x1280:d=2',
-        '-c:v', 'libx264', 'dummy_video.mp4'
-    ], check=True, stderr=subprocess.DEVNULL)
-
-    # Create dummy audio (2 seconds, sine wave)
-    subprocess.run([
-        'ffmpeg', '-y', '-f', 'lavfi', '-i', 'sine=f=440:d=2',
-        '-c:a', 'aac', 'dummy_audio.mp4'
+        'ffmpeg', '-y',
+        '-f', 'lavfi', '-i', 'color=c=black:s=720x1280:d=2',
+        '-f', 'lavfi', '-i', 'sine=f=440:d=2',
+        '-map', '0:v', '-c:v', 'libx264', 'dummy_video.mp4',
+        '-map', '1:a', '-c:a', 'aac', 'dummy_audio.mp4'
     ], check=True, stderr=subprocess.DEVNULL)
 
 def test_stitch():
@@ -23,7 +21,9 @@ def test_stitch():
         "video": os.path.abspath("dummy_video.mp4"),
         "audio": os.path.abspath("dummy_audio.mp4"),
         "text": "Hello World Test",
-        "duration": 2.0
+        "duration": 2.0,
+        # Optional: narration length in seconds, so stitch_clips skips probing the audio.
+        "audio_duration_s": 2.0
     }]
     
     with open("test_manifest.json", "w") as f:
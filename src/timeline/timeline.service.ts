@@ -1213,19 +1213,17 @@ export class TimelineService {
                     this.downloadFile(seg.videoUrl, localVideoPath)
                 ];
 
+                // Segments without narration omit `audio`; stitch_clips.py generates
+                // the silence inside its filter graph instead of a separate ffmpeg run.
                 if (seg.audioUrl) {
                     downloadPromises.push(this.downloadFile(seg.audioUrl, localAudioPath));
-                } else {
-                    // Generate silent audio matched to aligned duration
-                    // Note: ffmpeg 'anullsrc' is infinite, -t limits it.
-                    downloadPromises.push(exec(`ffmpeg -y -f lavfi -i anullsrc=r=44100:cl=stereo -t ${seg.targetDuration} -c:a libmp3lame -q:a 4 "${localAudioPath}"`));
                 }
 
                 await Promise.all(downloadPromises);
 
                 return {
                     video: localVideoPath,
-                    audio: localAudioPath,
+                    audio: seg.audioUrl ? localAudioPath : undefined,
                     text: seg.script || '',
                     alignment: (seg).alignment,
                     duration: seg.targetDuration // PASS THE SNAPPED DURATION